@@ -1,90 +1,256 @@
 # app.py
 import time
 import random
-from datetime import datetime
+import secrets
+import json
+import queue
+import sqlite3
+import logging
+import threading
+from types import MappingProxyType, SimpleNamespace
 
 import streamlit as st
+from streamlit.connections import BaseConnection
 import pandas as pd
 
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 from gspread.exceptions import APIError
+from gspread.utils import absolute_range_name
 
 # ------------------- CONFIG -------------------
 GOOGLE_SHEET_NAME = "UrbanSoundscapeData"   # 你的 Google 表格名
 WORKSHEET_INDEX = 0                         # 第几个工作表（0 表示第一个）
 
-# 刺激库
-STIMULI = [
-    {"id": "S01", "image": "i_qeop_3.jpg", "audio": "a_3_garden.wav"},
-    {"id": "S02", "image": "i_qeop_2.jpg", "audio": "a_2_spring music.wav"},
-    {"id": "S03", "image": "i_qeop_1.jpg", "audio": "a_1_east village.wav"},
-]
+# 刺激库（只读，避免在 rerun 之间被意外修改）
+STIMULI = (
+    MappingProxyType({"id": "S01", "image": "i_qeop_3.jpg", "audio": "a_3_garden.wav"}),
+    MappingProxyType({"id": "S02", "image": "i_qeop_2.jpg", "audio": "a_2_spring music.wav"}),
+    MappingProxyType({"id": "S03", "image": "i_qeop_1.jpg", "audio": "a_1_east village.wav"}),
+)
+
+CALIBRATION_AUDIO = "t_pinknoise_6s.wav"       # 开始前用于调节音量的测试音
+
+GENDER_OPTIONS = ("", "Female", "Male", "Non-binary", "Prefer not to say", "Other")
+
+# 声音类型；顺序即表格中各 satisfaction 列的顺序
+SOUND_COLS = (
+    "Birdsong", "Wind", "Water",
+    "Human voice", "Car", "Bicycle", "Airplane/Helicopter", "Construction noise", "Music", "Other"
+)
 
 TRIALS_PER_PARTICIPANT = min(3, len(STIMULI))  # 每位受试的试次数
 MIN_LISTEN_SECONDS = 3                         # 最少收听时长门槛
+LOCAL_DB_PATH = "responses.db"                 # 本地 SQLite，所有试次先写这里
+SYNC_INTERVAL = 60                             # 秒；后台线程定期把未同步的行写入表格
+SYNC_BATCH_SIZE = 500                          # 每次 values.append 最多写入的行数
 # ----------------------------------------------
 
 st.set_page_config(page_title="Urban Acoustic Comfort Test", page_icon="🎧", layout="centered")
 
-# -------------- Google Sheets 客户端 --------------
-@st.cache_resource(show_spinner=False)
-def get_gs_client():
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    try:
-        if "gcp_service_account" in st.secrets:
-            info = st.secrets["gcp_service_account"]
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(info, scope)
+# -------------- Google Sheets 连接 --------------
+RETRYABLE_STATUS = (429, 500, 503)   # 限流 / 服务端临时错误才重试
+
+def call_with_retry(fn, *args, max_retries=6, **kwargs):
+    # 指数退避 + 随机抖动：0.5s, 1s, 2s ... 上限 30s
+    for i in range(max_retries):
+        try:
+            return fn(*args, **kwargs)
+        except APIError as e:
+            code = getattr(e.response, "status_code", None)
+            if code not in RETRYABLE_STATUS or i == max_retries - 1:
+                raise
+            time.sleep(min(30, 0.5 * 2 ** i) + random.random() * 0.5)
+
+class SheetsAppendConnection(BaseConnection[gspread.Client]):
+    # 通过 st.connection 使用：缓存和 secrets.toml [connections.gsheets] 由 Streamlit 管理，
+    # access token 由 google-auth 的 AuthorizedSession 自动刷新
+    def _connect(self, **kwargs):
+        scope = [
+            "https://spreadsheets.google.com/feeds",
+            "https://www.googleapis.com/auth/drive"
+        ]
+        if self._secrets:
+            info = self._secrets.to_dict()
+        elif "gcp_service_account" in st.secrets:   # 旧的 secrets 写法
+            info = st.secrets["gcp_service_account"].to_dict()
         else:
-            creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
-        client = gspread.authorize(creds)
-        return client
-    except Exception as e:
-        st.error(f"Google Sheets auth failed: {e}")
-        st.stop()
+            info = None
+        if info is not None:
+            creds = Credentials.from_service_account_info(info, scopes=scope)
+        else:
+            creds = Credentials.from_service_account_file("credentials.json", scopes=scope)
+        return gspread.authorize(creds)
+
+    def sheet_target(self):
+        # 按当前 client 缓存 spreadsheet 和 A1 范围；reset() 或 secrets 变化换了 client 后重新查找
+        client = self._instance
+        if getattr(self, "_target_client", None) is not client:
+            sh = call_with_retry(client.open, GOOGLE_SHEET_NAME)
+            ws = call_with_retry(sh.get_worksheet, WORKSHEET_INDEX)
+            self._target = (sh, absolute_range_name(ws.title, "A1"))
+            self._target_client = client
+        return self._target
+
+    def append_rows(self, rows):
+        # 直接调用 v4 spreadsheets.values.append，RAW 写入，不做 USER_ENTERED 解析
+        sh, range_a1 = self.sheet_target()
+        call_with_retry(
+            sh.values_append,
+            range_a1,
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            body={"values": rows},
+        )
 
+# -------------- 本地存储 --------------
 @st.cache_resource(show_spinner=False)
-def open_worksheet():
-    client = get_gs_client()
-    sh = client.open(GOOGLE_SHEET_NAME)
-    ws = sh.get_worksheet(WORKSHEET_INDEX)
-    return ws
+def get_db():
+    # 所有会话共用一个连接，写操作用锁串行化
+    con = sqlite3.connect(LOCAL_DB_PATH, check_same_thread=False, isolation_level=None)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "id INTEGER PRIMARY KEY, row TEXT NOT NULL, synced INTEGER NOT NULL DEFAULT 0, error TEXT)"
+    )
+    # 早期建的表没有 error 列
+    if "error" not in {c[1] for c in con.execute("PRAGMA table_info(responses)")}:
+        con.execute("ALTER TABLE responses ADD COLUMN error TEXT")
+    return con, threading.Lock()
+
+def save_row(row):
+    con, lock = get_db()
+    with lock:
+        con.execute("INSERT INTO responses (row) VALUES (?)", (json.dumps(row),))
+
+# -------------- 后台同步线程 --------------
+WRITER_BATCH_WINDOW = 0.5    # 秒；被唤醒后稍等，把同时结束的会话合并成一次写入
+SYNC_THREAD_NAME = "sheets-sync"
+
+SYNC_FAILED = -1             # 被表格拒绝（400）或无法解析的行，不再重试，原因记在 error 列
+
+def _mark_rows(con, lock, ids, synced, error=None):
+    with lock:
+        con.executemany(
+            "UPDATE responses SET synced = ?, error = ? WHERE id = ?",
+            [(synced, error, rid) for rid in ids],
+        )
 
-def append_row_with_retry(ws, row_values, max_retries=1):
-    for i in range(max_retries):
+def _append_batch(conn, con, lock, batch):
+    # 400 / 解析失败是行本身的问题：二分找出坏行标记为失败，其余行照常写入
+    # 其他错误（限流、403/404、认证等）影响整张表，直接抛出，整批留到下一轮
+    try:
+        conn.append_rows([json.loads(row) for _, row in batch])
+    except (APIError, ValueError) as e:
+        if isinstance(e, APIError) and getattr(e.response, "status_code", None) != 400:
+            raise
+        if len(batch) > 1:
+            mid = len(batch) // 2
+            _append_batch(conn, con, lock, batch[:mid])
+            _append_batch(conn, con, lock, batch[mid:])
+            return
+        logging.error(f"Row {batch[0][0]} rejected, marked as failed: {e}")
+        _mark_rows(con, lock, [batch[0][0]], SYNC_FAILED, str(e))
+        return
+    _mark_rows(con, lock, [rid for rid, _ in batch], 1)
+
+def _sync_pending(conn, con, lock):
+    # 按批写入未同步的行；遇到影响整张表的错误就停下，下一轮再试
+    while True:
+        with lock:
+            pending = con.execute(
+                "SELECT id, row FROM responses WHERE synced = 0 ORDER BY id LIMIT ?",
+                (SYNC_BATCH_SIZE,),
+            ).fetchall()
+        if not pending:
+            return
+        ids = [rid for rid, _ in pending]
         try:
-            ws.append_row(row_values)
-            return True
-        except APIError:
-            wait = 2 ** i
-            time.sleep(wait)
-        except Exception as e:
-            st.warning(f"Append failed (attempt {i+1}/{max_retries}): {e}")
-            time.sleep(1)
-    return False
+            _append_batch(conn, con, lock, pending)
+        except APIError as e:
+            code = getattr(e.response, "status_code", None)
+            if code in RETRYABLE_STATUS:
+                logging.warning(f"Sheets sync still failing ({code}), retrying next round: {e}")
+            else:
+                logging.error(f"Sheets sync of rows {ids} stopped ({code}), unsynced rows are retried next round: {e}")
+            return
+        except Exception:
+            logging.exception(f"Sheets sync failed for rows {ids}, unsynced rows are retried next round")
+            return
+
+def _worker(sync):
+    while True:
+        # 有会话结束时被唤醒，否则每 SYNC_INTERVAL 秒检查一次（也负责重试失败的批次）
+        try:
+            try:
+                sync.queue.get(timeout=SYNC_INTERVAL)
+                time.sleep(WRITER_BATCH_WINDOW)
+            except queue.Empty:
+                pass
+            while not sync.queue.empty():
+                sync.queue.get_nowait()
+            con, lock = sync.db
+            _sync_pending(sync.conn, con, lock)
+        except Exception:
+            # 线程由 cache_resource 持有，不会被重建，任何异常都不能让它退出
+            logging.exception("Sheets sync loop failed, retrying next round")
+
+@st.cache_resource(show_spinner=False)
+def get_writer():
+    # 所有会话共用一个同步线程；往队列里放任意值即可唤醒它
+    # 这里只在本地构建凭据和 client；表格在第一次同步时才查找，Sheets 不可用也不影响答题
+    conn = st.connection("gsheets", type=SheetsAppendConnection)
+    # 缓存重建（改代码、cache_resource.clear()）时沿用已在运行的线程，只换上新的连接；
+    # 两个线程同时同步会选中同一批未同步的行，重复写入表格
+    for t in threading.enumerate():
+        if t.name == SYNC_THREAD_NAME and t.is_alive():
+            t.sync.conn, t.sync.db = conn, get_db()
+            return t.sync.queue
+    sync = SimpleNamespace(queue=queue.Queue(), conn=conn, db=get_db())
+    t = threading.Thread(target=_worker, args=(sync,), name=SYNC_THREAD_NAME, daemon=True)
+    t.sync = sync
+    t.start()
+    return sync.queue
+
+# -------------- 刺激文件缓存 --------------
+@st.cache_resource(show_spinner=False)
+def load_bytes(path):
+    # 图片/音频只从磁盘读一次；bytes 不可变，用 cache_resource 直接共享同一对象，避免每次 rerun 复制
+    with open(path, "rb") as f:
+        return f.read()
 
 # -------------- Session State 初始化 --------------
+# session_state 只放可 pickle 的普通数据（兼容 runner.enforceSerializableSessionState），
+# 队列、连接等进程级对象走 cache_resource
 def init_state():
     if "participant_id" not in st.session_state:
-        st.session_state.participant_id = "P_" + str(random.randint(100000, 999999))
+        st.session_state.participant_id = "P_" + secrets.token_hex(4)
     if "demographics_done" not in st.session_state:
         st.session_state.demographics_done = False
     if "trial_order" not in st.session_state:
-        order = STIMULI[:]
-        random.shuffle(order)
-        st.session_state.trial_order = order[:TRIALS_PER_PARTICIPANT]
+        # 存普通 dict 副本：MappingProxyType 不能 pickle，会话状态需保持可序列化
+        st.session_state.trial_order = [dict(s) for s in random.sample(STIMULI, TRIALS_PER_PARTICIPANT)]
     if "trial_idx" not in st.session_state:
         st.session_state.trial_idx = 0
     if "trial_start_time" not in st.session_state:
         st.session_state.trial_start_time = None
     if "form_unlocked_time" not in st.session_state:
         st.session_state.form_unlocked_time = None
+    if "sync_requested" not in st.session_state:
+        st.session_state.sync_requested = False
+    if "widget_keys" not in st.session_state:
+        # 每个试次提交后要清理的 widget key，会话开始时生成一次
+        st.session_state.widget_keys = tuple(
+            (f"comfort_{i}", f"pleasantness_{i}", f"match_{i}", f"multiselect_{i}")
+            + tuple(f"satisfaction_{s}_{i}" for s in SOUND_COLS)
+            for i in range(TRIALS_PER_PARTICIPANT)
+        )
 
 init_state()
-ws = open_worksheet()
+try:
+    writer = get_writer()   # 进程级对象，不放进 session_state，保持会话状态可序列化
+except Exception as e:
+    # 凭据缺失或无效：回答仍写入本地数据库，只是暂时无法同步到表格
+    writer = None
+    st.warning(f"Google Sheets is not configured, responses are only saved locally: {e}")
 
 # ------------------- UI：标题 -------------------
 st.title("Urban Acoustic Comfort Study")
@@ -103,13 +269,10 @@ if not st.session_state.demographics_done:
     with colA:
         age = st.number_input("Age", min_value=1, max_value=100, step=1, value=25)
     with colB:
-        gender = st.selectbox(
-            "Gender",
-            ["", "Female", "Male", "Non-binary", "Prefer not to say", "Other"]
-        )
+        gender = st.selectbox("Gender", GENDER_OPTIONS)
 
     st.write("Please put on your headphones and listen to the test audio and try not to adjust the volume again during the Trials.")
-    st.audio("t_pinknoise_6s.wav")
+    st.audio(load_bytes(CALIBRATION_AUDIO), format="audio/wav")
 
     disabled = not (consent and gender)
     if st.button("Begin trials", disabled=disabled):
@@ -130,9 +293,9 @@ if st.session_state.demographics_done and st.session_state.trial_idx < len(st.se
 
     col1, col2 = st.columns(2)
     with col1:
-        st.image(stim["image"], use_container_width=True, caption=f"Stimulus {stim['id']}")
+        st.image(load_bytes(stim["image"]), use_container_width=True, caption=f"Stimulus {stim['id']}")
     with col2:
-        st.audio(stim["audio"])
+        st.audio(load_bytes(stim["audio"]), format="audio/wav")
 
     if st.session_state.trial_start_time is None:
         st.session_state.trial_start_time = time.time()
@@ -143,54 +306,54 @@ if st.session_state.demographics_done and st.session_state.trial_idx < len(st.se
         st.info(f"Please listen to the sound before answering.")
         st.progress(min(1.0, elapsed / MIN_LISTEN_SECONDS))
 
-    # ------------------- 打分部分 -------------------
-    st.markdown("Acoustic comfort (0.00–1.00)")
-    st.caption("What's your overall impression after viewing the image and listening to the sound?")
-    comfort = st.slider("", 0.0, 1.0, 0.5, 0.01, key=f"comfort_{i}")
-    st.markdown("Pleasantness (0.00–1.00)")
-    st.caption("How you feel at this moment?")
-    pleasantness = st.slider("", 0.0, 1.0, 0.5, 0.01, key=f"pleasantness_{i}")
-    st.markdown("Soundscape Appropriateness (0.00–1.00)")
-    st.caption("Soundscape appropriateness (SA) was proposed as an indicator of whether a soundscape is suitable for a place.  \n:gray[Rated from 0.00(unsuitable) to 1.00(suitable)]")
-    match = st.slider("", 0.0, 1.0, 0.5, 0.01, key=f"match_{i}")
-
-    all_sound_types = [
-        "Birdsong", "Wind", "Water", 
-        "Human voice", "Car", "Bicycle", "Airplane/Helicopter", "Construction noise", "Music", "Other"
-    ]
+    # 声音类型放在表单外：它决定表单中出现哪些满意度滑块，选择后需要立即 rerun
     sound_types = st.multiselect(
         "Which kinds of sound did you hear? (Select-all-that-apply)",
-        all_sound_types,
+        SOUND_COLS,
         key=f"multiselect_{i}"
     )
 
-    ratings = {}
-    if sound_types:
-        st.write("Please rate your satisfaction with the selected sound(s):")
-        for sound in sound_types:
-            ratings[sound] = st.slider(
-                f"Satisfaction of {sound} ",
-                min_value=0.0,
-                max_value=1.0,
-                value=0.5,
-                step=0.01,
-                key=f"satisfaction_{sound}_{i}"
-            )
-
-    # ------------------- 提交按钮 -------------------
-    submitted = st.button("Submit this trial", disabled=not ready)
+    # ------------------- 打分部分 -------------------
+    # 表单内的滑块只在提交时触发一次 rerun
+    with st.form(f"trial_{i}"):
+        st.markdown("Acoustic comfort (0.00–1.00)")
+        st.caption("What's your overall impression after viewing the image and listening to the sound?")
+        comfort = st.slider("", 0.0, 1.0, 0.5, 0.01, key=f"comfort_{i}")
+        st.markdown("Pleasantness (0.00–1.00)")
+        st.caption("How you feel at this moment?")
+        pleasantness = st.slider("", 0.0, 1.0, 0.5, 0.01, key=f"pleasantness_{i}")
+        st.markdown("Soundscape Appropriateness (0.00–1.00)")
+        st.caption("Soundscape appropriateness (SA) was proposed as an indicator of whether a soundscape is suitable for a place.  \n:gray[Rated from 0.00(unsuitable) to 1.00(suitable)]")
+        match = st.slider("", 0.0, 1.0, 0.5, 0.01, key=f"match_{i}")
+
+        # 只有选了声音类型才创建满意度滑块
+        ratings = {}
+        if sound_types:
+            with st.expander("Rate what you heard", expanded=True):
+                st.write("Please rate your satisfaction with the selected sound(s):")
+                for sound in sound_types:
+                    ratings[sound] = st.slider(
+                        f"Satisfaction of {sound} ",
+                        min_value=0.0,
+                        max_value=1.0,
+                        value=0.5,
+                        step=0.01,
+                        key=f"satisfaction_{sound}_{i}"
+                    )
+
+        # ------------------- 提交按钮 -------------------
+        submitted = st.form_submit_button("Submit this trial", disabled=not ready)
 
     if submitted:
         if st.session_state.form_unlocked_time is None:
             st.session_state.form_unlocked_time = st.session_state.trial_start_time + MIN_LISTEN_SECONDS
         rt_ms = int((time.time() - st.session_state.form_unlocked_time) * 1000)
 
-        heard = {s: 9 for s in all_sound_types}
-        for s in sound_types:
-            heard[s] = ratings.get(s, 9)
+        # 未选择的声音记为 9
+        heard_cols = [ratings.get(s, 9) for s in SOUND_COLS]
 
         row = [
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            time.strftime("%Y-%m-%d %H:%M:%S"),
             st.session_state.participant_id,
             i,
             stim["id"],
@@ -198,35 +361,16 @@ if st.session_state.demographics_done and st.session_state.trial_idx < len(st.se
             stim["audio"],
             st.session_state.base_info["age"],
             st.session_state.base_info["gender"],
-            float(comfort),
-            float(pleasantness),
-            float(match),
-            heard["Birdsong"],
-            heard["Wind"],
-            heard["Water"],
-            heard["Human voice"],
-            heard["Car"],
-            heard["Bicycle"],
-            heard["Airplane/Helicopter"],
-            heard["Construction noise"],
-            heard["Music"],
-            heard["Other"],
-            rt_ms
-        ]
+            comfort,
+            pleasantness,
+            match,
+        ] + heard_cols + [rt_ms]
 
-        ok = append_row_with_retry(ws, row)
-        if ok:
-            st.success("✅ Trial submitted.")
-        else:
-            st.error("❌ Failed to write to Google Sheets.")
+        save_row(row)
 
         # ------------------- 清理 widget 状态 -------------------
-        st.session_state.pop(f"comfort_{i}", None)
-        st.session_state.pop(f"pleasantness_{i}", None)
-        st.session_state.pop(f"match_{i}", None)
-        st.session_state.pop(f"multiselect_{i}", None)
-        for s in all_sound_types:
-            st.session_state.pop(f"satisfaction_{s}_{i}", None)
+        for k in st.session_state.widget_keys[i]:
+            st.session_state.pop(k, None)
 
         # 下一试
         st.session_state.trial_idx += 1
@@ -234,8 +378,26 @@ if st.session_state.demographics_done and st.session_state.trial_idx < len(st.se
         st.session_state.form_unlocked_time = None
         st.rerun()
 
+    # 提前结束：保存已完成的试次并跳到结束页
+    if i > 0 and st.button("Save & exit"):
+        st.session_state.trial_idx = len(st.session_state.trial_order)
+        st.session_state.trial_start_time = None
+        st.session_state.form_unlocked_time = None
+        st.rerun()
+
+    # 收听时长未到：页面已渲染完，等到门槛时间后 rerun 一次以启用提交按钮
+    # 单次等待不超过 3 秒，避免长时间阻塞脚本
+    if not ready:
+        time.sleep(min(3.0, MIN_LISTEN_SECONDS - elapsed))
+        st.rerun()
+
 # ----------------- 结束页 -----------------
 if st.session_state.demographics_done and st.session_state.trial_idx >= len(st.session_state.trial_order):
+    # 试次已在本地保存；唤醒后台线程尽快同步到表格，每个会话只唤醒一次
+    if writer is not None and not st.session_state.sync_requested:
+        writer.put(None)
+        st.session_state.sync_requested = True
+
     st.subheader("All done — thank you!")
     st.write("Your responses have been recorded.")
     st.write(f"Participant ID: **{st.session_state.participant_id}**")